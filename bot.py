@@ -3,30 +3,53 @@ import asyncio
 import re
 import json
 import time
-import threading
+import functools
+import itertools
 import hmac
-import hashlib
+import atexit
+import queue
+import logging
+import logging.handlers
 from html import escape
+from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, F
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command, CommandObject
+from aiogram.methods import SendMessage, EditMessageText
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, Document
 )
 import aiohttp
 import aiosqlite
-from flask import Flask, request, abort
+import orjson
+from aiohttp import web
+
+# ==================== LOGGING ====================
+# The root handler only queues records; a listener thread writes them out,
+# so a burst of webhook errors never blocks the event loop on console I/O.
+_LOG_QUEUE = queue.SimpleQueue()
+_LOG_HANDLER = logging.StreamHandler()
+_LOG_HANDLER.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_LOG_ENQUEUE = logging.handlers.QueueHandler(_LOG_QUEUE)
+_LOG_ENQUEUE.setFormatter(logging.Formatter("%(message)s"))  # the listener's handler adds the prefix
+logging.basicConfig(level=logging.INFO, handlers=[_LOG_ENQUEUE])
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, _LOG_HANDLER)
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)
+log = logging.getLogger("bot")
 
 # ==================== CONFIG ====================
 load_dotenv()
 
 TOKEN = os.getenv("TELEGRAM_TOKEN")
-ADMIN_IDS = {int(x.strip()) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+ADMIN_IDS = frozenset(int(x.strip()) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip())
 
 # --- Paymob Variables ---
 PAYMOB_API_KEY = os.getenv("PAYMOB_API_KEY")
 PAYMOB_HMAC_SECRET = os.getenv("PAYMOB_HMAC_SECRET")
+PAYMOB_HMAC_SECRET_BYTES = (PAYMOB_HMAC_SECRET or "").encode('utf-8')
 PAYMOB_CARD_ID = int(os.getenv("PAYMOB_CARD_INTEGRATION_ID", 0))
 PAYMOB_WALLET_ID = int(os.getenv("PAYMOB_WALLET_INTEGRATION_ID", 0))
 PAYMOB_IFRAME_ID = int(os.getenv("PAYMOB_IFRAME_ID", 0))
@@ -34,26 +57,100 @@ PAYMOB_IFRAME_ID = int(os.getenv("PAYMOB_IFRAME_ID", 0))
 if not TOKEN:
     raise RuntimeError("Please set TELEGRAM_TOKEN in .env")
 
-print("Loaded ADMIN_IDS:", ADMIN_IDS)
+log.info("Loaded ADMIN_IDS: %s", set(ADMIN_IDS))
 
 bot = Bot(token=TOKEN)
 dp = Dispatcher()
-flask_app = Flask(__name__)
+routes = web.RouteTableDef()
 
 # ==================== DB ====================
 DB_PATH = "store.db"
 
+DB_READERS_COUNT = int(os.getenv("DB_READERS", 4))
+DB_STMT_CACHE = 256
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_OPTIMIZE_EVERY = 15 * 60
+
+# 1 when an unsold row still has a sellable mode, honouring chosen_mode once it is set.
+AVAILABLE_SQL = "CASE WHEN IFNULL(is_sold,0)=0 AND ((chosen_mode IS NULL AND (IFNULL(p_cap,0)>IFNULL(p_sold,0) OR IFNULL(s_cap,0)>IFNULL(s_sold,0) OR IFNULL(l_cap,0)>IFNULL(l_sold,0))) OR (chosen_mode='personal' AND IFNULL(p_cap,0) > IFNULL(p_sold,0)) OR (chosen_mode='shared' AND IFNULL(s_cap,0) > IFNULL(s_sold,0)) OR (chosen_mode='laptop' AND IFNULL(l_cap,0) > IFNULL(l_sold,0))) THEN 1 ELSE 0 END"
+
+# One long-lived writer connection shared by every write helper; opened in init_db(), closed on shutdown.
+DB: aiosqlite.Connection | None = None
+# Serializes write units on the shared connection so one coroutine's commit can't split another's statements.
+DB_WRITE_LOCK = asyncio.Lock()
+# Read-only connections; under WAL they read concurrently with the writer.
+DB_READERS: asyncio.Queue = asyncio.Queue()
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""CREATE TABLE IF NOT EXISTS users(user_id INTEGER PRIMARY KEY, balance REAL DEFAULT 0);""")
-        await db.execute("""CREATE TABLE IF NOT EXISTS stock(id INTEGER PRIMARY KEY AUTOINCREMENT, category TEXT NOT NULL, price REAL NOT NULL DEFAULT 0, credential TEXT NOT NULL, is_sold INTEGER DEFAULT 0, p_price REAL, p_cap INTEGER, p_sold INTEGER DEFAULT 0, s_price REAL, s_cap INTEGER, s_sold INTEGER DEFAULT 0, l_price REAL, l_cap INTEGER, l_sold INTEGER DEFAULT 0, chosen_mode TEXT);""")
-        await db.execute("""CREATE TABLE IF NOT EXISTS sales_history(id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, stock_id INTEGER NOT NULL, category TEXT, credential TEXT, price_paid REAL, mode_sold TEXT, purchase_date TEXT DEFAULT (DATETIME('now', 'localtime')));""")
-        await db.execute("""CREATE TABLE IF NOT EXISTS instructions(category TEXT NOT NULL, mode TEXT NOT NULL, message_text TEXT NOT NULL, PRIMARY KEY (category, mode));""")
-        await db.commit()
+    global DB
+    DB = await aiosqlite.connect(DB_PATH, isolation_level="IMMEDIATE", cached_statements=DB_STMT_CACHE)
+    await DB.executescript(f"PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY; PRAGMA cache_size=-64000; PRAGMA wal_autocheckpoint=1000; PRAGMA mmap_size={DB_MMAP_SIZE};")
+    async with writer():
+        await DB.execute("""CREATE TABLE IF NOT EXISTS users(user_id INTEGER PRIMARY KEY, balance REAL DEFAULT 0);""")
+        await DB.execute("""CREATE TABLE IF NOT EXISTS stock(id INTEGER PRIMARY KEY AUTOINCREMENT, category TEXT NOT NULL, price REAL NOT NULL DEFAULT 0, credential TEXT NOT NULL, is_sold INTEGER DEFAULT 0, p_price REAL, p_cap INTEGER, p_sold INTEGER DEFAULT 0, s_price REAL, s_cap INTEGER, s_sold INTEGER DEFAULT 0, l_price REAL, l_cap INTEGER, l_sold INTEGER DEFAULT 0, chosen_mode TEXT);""")
+        await DB.execute("""CREATE TABLE IF NOT EXISTS sales_history(id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, stock_id INTEGER NOT NULL, category TEXT, credential TEXT, price_paid REAL, mode_sold TEXT, purchase_date TEXT DEFAULT (DATETIME('now', 'localtime')));""")
+        await DB.execute("""CREATE TABLE IF NOT EXISTS instructions(category TEXT NOT NULL, mode TEXT NOT NULL, message_text TEXT NOT NULL, PRIMARY KEY (category, mode));""")
+        # An earlier schema had a generated stock.available column and its index; nothing reads them
+        # now, and the index only added upkeep to every sale and import.
+        await DB.execute("DROP INDEX IF EXISTS idx_stock_available")
+        cur = await DB.execute("PRAGMA table_xinfo(stock)")
+        if "available" in {row[1] for row in await cur.fetchall()}:
+            await DB.execute("ALTER TABLE stock DROP COLUMN available")
+        # Partial index over live rows only; the WHERE must match the IFNULL(is_sold,0)=0 predicate used by the stock queries.
+        await DB.execute("""CREATE INDEX IF NOT EXISTS idx_stock_avail ON stock(category, id) WHERE IFNULL(is_sold,0)=0;""")
+        # Covers every column the catalog scans read, so they never load the (large) credential pages.
+        await DB.execute("""CREATE INDEX IF NOT EXISTS idx_stock_modes ON stock(category, is_sold, price, p_price, p_cap, p_sold, s_price, s_cap, s_sold, l_price, l_cap, l_sold, chosen_mode) WHERE IFNULL(is_sold,0)=0;""")
+        await DB.execute("""CREATE INDEX IF NOT EXISTS idx_sales_user ON sales_history(user_id);""")
+        # first start on this file: collect planner stats so the partial/covering indexes get picked
+        cur = await DB.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'")
+        if await cur.fetchone() is None:
+            await DB.execute("ANALYZE")
+    for _ in range(DB_READERS_COUNT):
+        conn = await aiosqlite.connect(f"file:{DB_PATH}?mode=ro", uri=True, cached_statements=DB_STMT_CACHE)
+        await conn.executescript(f"PRAGMA temp_store=MEMORY; PRAGMA cache_size=-16000; PRAGMA mmap_size={DB_MMAP_SIZE};")
+        DB_READERS.put_nowait(conn)
+
+async def close_db():
+    global DB
+    while not DB_READERS.empty():
+        await DB_READERS.get_nowait().close()
+    if DB is not None:
+        await DB.close()
+        DB = None
+
+# One write unit on the shared connection: commits on success, rolls back on any error or
+# cancellation so a half-done transaction is never left for the next writer to commit.
+@asynccontextmanager
+async def writer():
+    async with DB_WRITE_LOCK:
+        try:
+            yield DB
+        except BaseException:
+            await DB.rollback()
+            raise
+        await DB.commit()
+
+@asynccontextmanager
+async def reader():
+    conn = await DB_READERS.get()
+    try:
+        yield conn
+    finally:
+        DB_READERS.put_nowait(conn)
+
+# keeps planner stats fresh as stock churns; started from main()
+async def optimize_db_loop():
+    while True:
+        await asyncio.sleep(DB_OPTIMIZE_EVERY)
+        try:
+            async with writer():
+                await DB.execute("PRAGMA optimize")
+        except Exception as e:
+            log.warning("optimize failed: %s", e)
 
 async def migrate_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("PRAGMA table_info(stock)")
+    async with writer():
+        cur = await DB.execute("PRAGMA table_info(stock)")
         cols = {row[1] for row in await cur.fetchall()}
         to_add = [
             ("p_price","REAL"),("p_cap","INTEGER"),("p_sold","INTEGER DEFAULT 0"),
@@ -64,186 +161,333 @@ async def migrate_db():
         for name, spec in to_add:
             if name not in cols:
                 try:
-                    await db.execute(f"ALTER TABLE stock ADD COLUMN {name} {spec}")
+                    await DB.execute(f"ALTER TABLE stock ADD COLUMN {name} {spec}")
                 except Exception as e:
-                    print("[WARN] migration:", name, e)
-        await db.commit()
+                    log.warning("migration %s failed: %s", name, e)
 
 # ==================== HELPERS ====================
 def is_admin(uid: int) -> bool:
     return uid in ADMIN_IDS
 
+# admin handlers are registered with this filter so non-admin updates never reach them
+ADMIN_ONLY = F.from_user.id.in_(ADMIN_IDS)
+
+_DIGIT_MAP = str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789")
+_FLOAT_RE = re.compile(r'[-+]?\d+(?:\.\d+)?')
+_INT_RE = re.compile(r'\d{1,12}')
+
 def normalize_digits(s: str) -> str:
-    return s.translate(str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789"))
+    return s.translate(_DIGIT_MAP)
+
+def _is_plain_decimal(s: str) -> bool:
+    # ASCII "123" or "12.5" only, i.e. exactly what _FLOAT_RE would extract unchanged.
+    whole, dot, frac = s.partition(".")
+    return s.isascii() and whole.isdigit() and (not dot or frac.isdigit())
 
+@functools.lru_cache(maxsize=256)
 def parse_float_loose(s: str):
     if not s: return None
+    if _is_plain_decimal(s): return float(s)
     s = normalize_digits(s).replace(",", ".")
-    m = re.search(r'[-+]?\d+(?:\.\d+)?', s)
+    m = _FLOAT_RE.search(s)
     return float(m.group(0)) if m else None
 
+@functools.lru_cache(maxsize=256)
 def parse_int_loose(s: str):
     if not s: return None
+    if len(s) <= 12 and s.isascii() and s.isdigit(): return int(s)
     s = normalize_digits(s)
-    m = re.search(r'\d{1,12}', s)
+    m = _INT_RE.search(s)
     return int(m.group(0)) if m else None
 
-def main_menu_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💳 شحن الرصيد (آلي)", callback_data="charge_menu")],
-        [InlineKeyboardButton(text="🛍️ الكتالوج / شراء", callback_data="catalog")],
-        [InlineKeyboardButton(text="💼 رصيدي", callback_data="balance")],
-    ])
+# Static keyboards are built once at import and reused by every handler.
+MAIN_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="💳 شحن الرصيد (آلي)", callback_data="charge_menu")],
+    [InlineKeyboardButton(text="🛍️ الكتالوج / شراء", callback_data="catalog")],
+    [InlineKeyboardButton(text="💼 رصيدي", callback_data="balance")],
+])
+BACK_HOME_BTN = InlineKeyboardButton(text="🔙 رجوع", callback_data="back_home")
+BACK_CATALOG_BTN = InlineKeyboardButton(text="🔙 رجوع", callback_data="catalog")
+MODE_NAMES = {"personal": "فردي", "shared": "مشترك", "laptop": "لابتوب"}
+# mode -> (price, cap, sold) stock columns, and the price's position in a FIND_ITEM_SQL row
+MODE_COLS = {"personal": ("p_price", "p_cap", "p_sold"), "shared": ("s_price", "s_cap", "s_sold"), "laptop": ("l_price", "l_cap", "l_sold")}
+MODE_PRICE_IDX = {"personal": 5, "shared": 8, "laptop": 11}
 
 # ---- users / balances ----
 async def get_or_create_user(user_id: int) -> float:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
+    async with reader() as db, db.execute("SELECT balance FROM users WHERE user_id=?", (user_id,)) as cur:
         r = await cur.fetchone()
-        if r is None:
-            await db.execute("INSERT INTO users(user_id,balance) VALUES(?,0)", (user_id,))
-            await db.commit()
-            return 0.0
-        return float(r[0])
-
-async def set_balance(user_id: int, bal: float):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT INTO users(user_id,balance) VALUES(?,?) ON CONFLICT(user_id) DO UPDATE SET balance=excluded.balance", (user_id, bal))
-        await db.commit()
+    if r is None:
+        async with writer():
+            await DB.execute("INSERT OR IGNORE INTO users(user_id,balance) VALUES(?,0)", (user_id,))
+        return 0.0
+    return float(r[0])
 
 async def change_balance(user_id: int, delta: float) -> bool:
-    bal = await get_or_create_user(user_id)
-    new_bal = bal + delta
-    if new_bal < 0: return False
-    await set_balance(user_id, new_bal)
-    return True
+    async with writer():
+        await DB.execute("INSERT OR IGNORE INTO users(user_id,balance) VALUES(?,0)", (user_id,))
+        cur = await DB.execute("UPDATE users SET balance=balance+? WHERE user_id=? AND balance+?>=0", (delta, user_id, delta))
+    return cur.rowcount == 1
 
 # ---- stock helpers ----
-async def add_stock_row_modes(category: str, credential: str, p_price=None,p_cap=None, s_price=None,s_cap=None, l_price=None,l_cap=None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT INTO stock(category, price, credential, p_price, p_cap, s_price, s_cap, l_price, l_cap) VALUES (?,?,?,?,?,?,?,?,?)", (category, 0, credential, p_price, p_cap, s_price, s_cap, l_price, l_cap))
-        await db.commit()
-
-async def add_stock_simple(category: str, price: float, credential: str):
-    await add_stock_row_modes(category, credential, p_price=price, p_cap=1, s_price=None, s_cap=0, l_price=None, l_cap=0)
+# category -> available items; loaded once at startup and kept in step with every stock write.
+CATEGORY_COUNTS: dict[str, int] = {}
+
+async def load_category_counts():
+    async with reader() as db, db.execute(f"SELECT category, COUNT(*) FROM stock WHERE IFNULL(is_sold,0)=0 AND {AVAILABLE_SQL}=1 GROUP BY category") as cur:
+        rows = await cur.fetchall()
+    CATEGORY_COUNTS.clear()
+    CATEGORY_COUNTS.update(rows)
+
+def bump_category_count(category: str, delta: int):
+    n = CATEGORY_COUNTS.get(category, 0) + delta
+    if n > 0: CATEGORY_COUNTS[category] = n
+    else: CATEGORY_COUNTS.pop(category, None)
+
+# ---- short-lived read cache ----
+# key -> (created_at, version, task); concurrent callers share the task, stock writes bump the version.
+CACHE_TTL = 2.0
+_CACHE: dict[tuple, tuple] = {}
+_CACHE_VERSION = 0
+
+def invalidate_cache():
+    global _CACHE_VERSION
+    _CACHE_VERSION += 1
+    _CACHE.clear()
+
+async def cached(key: tuple, ttl: float, fn):
+    now = time.monotonic()
+    hit = _CACHE.get(key)
+    if hit and hit[1] == _CACHE_VERSION and now - hit[0] < ttl:
+        return await hit[2]
+    entry = (now, _CACHE_VERSION, asyncio.ensure_future(fn()))
+    _CACHE[key] = entry
+    try:
+        return await entry[2]
+    except Exception:
+        if _CACHE.get(key) is entry: del _CACHE[key]
+        raise
+
+STOCK_INSERT_SQL = "INSERT INTO stock(category, price, credential, p_price, p_cap, s_price, s_cap, l_price, l_cap) VALUES (?,?,?,?,?,?,?,?,?)"
+
+# Rows are built by the import parsers in STOCK_INSERT_SQL order; the whole batch is one transaction.
+async def add_stock_rows(rows: list) -> int:
+    if not rows: return 0
+    async with writer():
+        await DB.executemany(STOCK_INSERT_SQL, rows)
+    for row in rows:
+        if any((cap or 0) > 0 for cap in (row[4], row[6], row[8])):
+            bump_category_count(row[0], 1)
+    invalidate_cache()
+    return len(rows)
 
 async def clear_stock_category(category: str) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("DELETE FROM stock WHERE category=?", (category,))
-        await db.commit()
-        return cur.rowcount
+    async with writer():
+        cur = await DB.execute("DELETE FROM stock WHERE category=?", (category,))
+    CATEGORY_COUNTS.pop(category, None)
+    invalidate_cache()
+    return cur.rowcount
 
 async def delete_stock_item(stock_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("DELETE FROM stock WHERE id=?", (stock_id,))
-        await db.commit()
-        return cur.rowcount
+    async with writer():
+        cur = await DB.execute(f"SELECT category, {AVAILABLE_SQL} FROM stock WHERE id=?", (stock_id,))
+        row = await cur.fetchone()
+        cur = await DB.execute("DELETE FROM stock WHERE id=?", (stock_id,))
+    if row and row[1]:
+        bump_category_count(row[0], -1)
+    invalidate_cache()
+    return cur.rowcount
 
 async def list_stock_items(category: str, limit: int = 20):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id, price, credential, p_price, s_price, l_price FROM stock WHERE IFNULL(is_sold,0)=0 AND category=? ORDER BY id ASC LIMIT ?", (category, limit))
+    async with reader() as db, db.execute("SELECT id, price, credential, p_price, s_price, l_price FROM stock WHERE IFNULL(is_sold,0)=0 AND category=? ORDER BY id ASC LIMIT ?", (category, limit)) as cur:
         return await cur.fetchall()
 
-def remaining_for_mode(row, mode):
-    idx = {"personal": (6,7), "shared": (9,10), "laptop": (12,13)}[mode]
-    cap = row[idx[0]] if row[idx[0]] is not None else 0
-    sold = row[idx[1]] if row[idx[1]] is not None else 0
-    return max(cap - sold, 0)
-
 def price_for_mode(row, mode):
-    col = {"personal":5, "shared":8, "laptop":11}[mode]
-    pr = row[col]
+    pr = row[MODE_PRICE_IDX[mode]]
     return pr if pr is not None else row[2]
 
 async def list_categories():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT category, SUM(CASE WHEN (chosen_mode IS NULL AND (IFNULL(p_cap,0)>IFNULL(p_sold,0) OR IFNULL(s_cap,0)>IFNULL(s_sold,0) OR IFNULL(l_cap,0)>IFNULL(l_sold,0))) OR (chosen_mode='personal' AND IFNULL(p_cap,0) > IFNULL(p_sold,0)) OR (chosen_mode='shared' AND IFNULL(s_cap,0) > IFNULL(s_sold,0)) OR (chosen_mode='laptop' AND IFNULL(l_cap,0) > IFNULL(l_sold,0)) THEN 1 ELSE 0 END) AS items_available FROM stock WHERE IFNULL(is_sold,0)=0 GROUP BY category ORDER BY category")
-        return await cur.fetchall()
+    return sorted(CATEGORY_COUNTS.items())
 
 async def list_modes_for_category(category: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id, category, price, credential, IFNULL(is_sold,0), p_price, p_cap, IFNULL(p_sold,0), s_price, s_cap, IFNULL(s_sold,0), l_price, l_cap, IFNULL(l_sold,0), chosen_mode FROM stock WHERE category=? AND IFNULL(is_sold,0)=0 ORDER BY id ASC", (category,))
-        items = await cur.fetchall()
+    return await cached(("modes", category), CACHE_TTL, lambda: _load_modes_for_category(category))
+
+# One aggregate pass over the category's live rows: (count, min price) per mode, read from idx_stock_modes alone.
+def _mode_summary_cols(mode: str, price_col: str, cap_col: str, sold_col: str) -> str:
+    sellable = f"IFNULL({cap_col},0) > IFNULL({sold_col},0) AND (chosen_mode IS NULL OR chosen_mode='{mode}')"
+    return f"SUM({sellable}), MIN(CASE WHEN {sellable} THEN COALESCE({price_col}, price) END)"
+
+MODES_SUMMARY_SQL = f"SELECT {', '.join(_mode_summary_cols(mode, *cols) for mode, cols in MODE_COLS.items())} FROM stock WHERE category=? AND IFNULL(is_sold,0)=0"
+
+async def _load_modes_for_category(category: str):
+    async with reader() as db, db.execute(MODES_SUMMARY_SQL, (category,)) as cur:
+        row = await cur.fetchone()
     res = {}
-    for mode in ("personal","shared","laptop"):
-        min_price, count = None, 0
-        for r in items:
-            chosen = r[14]
-            rem = remaining_for_mode(r, mode)
-            if rem <= 0: continue
-            if chosen is None or chosen == mode:
-                pr = price_for_mode(r, mode)
-                if pr is None: continue
-                count += 1
-                if min_price is None or pr < min_price: min_price = pr
-        if count > 0:
-            res[mode] = {"count": count, "min_price": min_price}
+    for i, mode in enumerate(MODE_COLS):
+        count, min_price = row[2*i], row[2*i + 1]
+        if count: res[mode] = {"count": count, "min_price": min_price}
     return res
 
+# SQL text is fixed per mode so sqlite3's statement cache reuses the prepared statement on every call
+FIND_ITEM_SQL = {
+    mode: f"SELECT id, category, price, credential, IFNULL(is_sold,0), p_price, p_cap, IFNULL(p_sold,0), s_price, s_cap, IFNULL(s_sold,0), l_price, l_cap, IFNULL(l_sold,0), chosen_mode FROM stock WHERE id=(SELECT id FROM stock WHERE category=? AND IFNULL(is_sold,0)=0 AND (IFNULL({cap_col},0) > IFNULL({sold_col},0)) AND {price_col} IS NOT NULL AND (chosen_mode IS NULL OR chosen_mode=?) ORDER BY (IFNULL({cap_col},0) - IFNULL({sold_col},0)) ASC, id ASC LIMIT 1)"
+    for mode, (price_col, cap_col, sold_col) in MODE_COLS.items()
+}
+
 async def find_item_with_mode(category: str, mode: str):
-    cap_col, sold_col = {"personal": ("p_cap", "p_sold"), "shared": ("s_cap", "s_sold"), "laptop": ("l_cap", "l_sold")}[mode]
-    price_col = {"personal": "p_price", "shared": "s_price", "laptop": "l_price"}[mode]
-    
-    async with aiosqlite.connect(DB_PATH) as db:
-        query = f"SELECT id, category, price, credential, IFNULL(is_sold,0), p_price, p_cap, IFNULL(p_sold,0), s_price, s_cap, IFNULL(s_sold,0), l_price, l_cap, IFNULL(l_sold,0), chosen_mode FROM stock WHERE category=? AND IFNULL(is_sold,0)=0 AND (IFNULL({cap_col},0) > IFNULL({sold_col},0)) AND {price_col} IS NOT NULL AND (chosen_mode IS NULL OR chosen_mode=?) ORDER BY (IFNULL({cap_col},0) - IFNULL({sold_col},0)) ASC, id ASC LIMIT 1"
-        cur = await db.execute(query, (category, mode))
+    async with reader() as db, db.execute(FIND_ITEM_SQL[mode], (category, mode)) as cur:
         return await cur.fetchone()
 
-async def increment_sale_and_finalize(stock_row, mode: str):
-    id_ = stock_row[0]
-    sold_field, cap_field = {"personal": ("p_sold","p_cap"), "shared": ("s_sold","s_cap"), "laptop": ("l_sold","l_cap")}[mode]
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(f"SELECT {sold_field},{cap_field},chosen_mode FROM stock WHERE id=?", (id_,))
-        s, cap, ch = await cur.fetchone()
-        ch = mode if ch is None else ch
-        if ch != mode: return False
-        s = 0 if s is None else s
-        cap = 0 if cap is None else cap
-        if s >= cap: return False
-        s += 1
-        is_sold_val = 1 if s >= cap else 0
-        await db.execute(f"UPDATE stock SET {sold_field}=?, chosen_mode=?, is_sold=CASE WHEN ?=1 THEN 1 ELSE IFNULL(is_sold,0) END WHERE id=?", (s, ch, is_sold_val, id_))
-        await db.commit()
-    return True
-
-async def log_sale(user_id: int, stock_row: tuple, price: float, mode: str):
-    stock_id, category, _, credential, *_ = stock_row
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT INTO sales_history(user_id, stock_id, category, credential, price_paid, mode_sold) VALUES (?, ?, ?, ?, ?, ?)", (user_id, stock_id, category, credential, price, mode))
-        await db.commit()
+# display-only lookup (price preview); the purchase itself always re-picks inside claim_and_log
+async def peek_item_with_mode(category: str, mode: str):
+    return await cached(("item", category, mode), CACHE_TTL, lambda: find_item_with_mode(category, mode))
+
+# Picks (same order as FIND_ITEM_SQL) and claims the item in one statement, returning what the sale needs.
+CLAIM_ITEM_SQL = {
+    mode: f"UPDATE stock SET {sold_col}=IFNULL({sold_col},0)+1, chosen_mode=?, is_sold=CASE WHEN IFNULL({sold_col},0)+1 >= IFNULL({cap_col},0) THEN 1 ELSE IFNULL(is_sold,0) END WHERE id=(SELECT id FROM stock WHERE category=? AND IFNULL(is_sold,0)=0 AND (IFNULL({cap_col},0) > IFNULL({sold_col},0)) AND {price_col} IS NOT NULL AND (chosen_mode IS NULL OR chosen_mode=?) ORDER BY (IFNULL({cap_col},0) - IFNULL({sold_col},0)) ASC, id ASC LIMIT 1) RETURNING id, credential, {price_col}, is_sold"
+    for mode, (price_col, cap_col, sold_col) in MODE_COLS.items()
+}
+
+class InsufficientBalance(Exception):
+    def __init__(self, balance: float, price: float):
+        super().__init__(balance, price)
+        self.balance, self.price = balance, price
+
+# Whole purchase in one write transaction: claim the item, debit the balance and log the sale.
+# Returns None when nothing is in stock, else (credential, price, new_balance);
+# raises InsufficientBalance when the balance is too low. Any error rolls the whole unit back.
+async def claim_and_log(user_id: int, category: str, mode: str):
+    async with writer():
+        await DB.execute("INSERT OR IGNORE INTO users(user_id,balance) VALUES(?,0)", (user_id,))
+        cur = await DB.execute(CLAIM_ITEM_SQL[mode], (mode, category, mode))
+        claimed = await cur.fetchone()
+        await cur.close()
+        if claimed is None:
+            await DB.rollback()
+            return None
+        stock_id, credential, price, sold_out = claimed
+        price = float(price)  # RETURNING skips REAL affinity, so whole prices come back as int
+        cur = await DB.execute("UPDATE users SET balance=balance-? WHERE user_id=? AND balance>=? RETURNING balance", (price, user_id, price))
+        paid = await cur.fetchone()
+        await cur.close()
+        if paid is None:
+            cur = await DB.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
+            row = await cur.fetchone()
+            await cur.close()
+            raise InsufficientBalance(float(row[0]), price)
+        await DB.execute("INSERT INTO sales_history(user_id, stock_id, category, credential, price_paid, mode_sold) VALUES (?, ?, ?, ?, ?, ?)", (user_id, stock_id, category, credential, price, mode))
+    if sold_out:
+        bump_category_count(category, -1)
+    invalidate_cache()
+    return credential, price, float(paid[0])
 
 async def get_sales_history(limit: int = 20):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT user_id, category, credential, price_paid, mode_sold, purchase_date FROM sales_history ORDER BY id DESC LIMIT ?", (limit,))
+    async with reader() as db, db.execute("SELECT user_id, category, credential, price_paid, mode_sold, purchase_date FROM sales_history ORDER BY id DESC LIMIT ?", (limit,)) as cur:
         return await cur.fetchall()
 
+# (category, mode) -> message_text or None; only changed through set/delete_instruction, so no TTL.
+# Kept apart from _CACHE because every sale clears that one.
+INSTRUCTIONS_CACHE: dict[tuple[str, str], str | None] = {}
+
 async def set_instruction(category: str, mode: str, message: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT INTO instructions(category, mode, message_text) VALUES (?, ?, ?) ON CONFLICT(category, mode) DO UPDATE SET message_text=excluded.message_text", (category, mode, message))
-        await db.commit()
+    async with writer():
+        await DB.execute("INSERT INTO instructions(category, mode, message_text) VALUES (?, ?, ?) ON CONFLICT(category, mode) DO UPDATE SET message_text=excluded.message_text", (category, mode, message))
+    INSTRUCTIONS_CACHE[(category, mode)] = message
 
 async def get_instruction(category: str, mode: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT message_text FROM instructions WHERE category=? AND mode=?", (category, mode))
+    key = (category, mode)
+    if key in INSTRUCTIONS_CACHE: return INSTRUCTIONS_CACHE[key]
+    async with reader() as db, db.execute("SELECT message_text FROM instructions WHERE category=? AND mode=?", key) as cur:
         row = await cur.fetchone()
-        return row[0] if row else None
+    return INSTRUCTIONS_CACHE.setdefault(key, row[0] if row else None)
 
 async def delete_instruction(category: str, mode: str) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("DELETE FROM instructions WHERE category=? AND mode=?", (category, mode))
-        await db.commit()
-        return cur.rowcount
+    async with writer():
+        cur = await DB.execute("DELETE FROM instructions WHERE category=? AND mode=?", (category, mode))
+    INSTRUCTIONS_CACHE[(category, mode)] = None
+    return cur.rowcount
 
 async def get_all_instructions():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT category, mode, message_text FROM instructions ORDER BY category, mode")
+    async with reader() as db, db.execute("SELECT category, mode, message_text FROM instructions ORDER BY category, mode") as cur:
         return await cur.fetchall()
 
+# ---- outgoing messages ----
+# Bot-wide token bucket in front of every sendMessage/editMessageText (Telegram allows ~30/s per bot),
+# so bursts queue briefly here instead of turning into 429 retry storms.
+TG_RATE = 30
+_TG_TOKENS = float(TG_RATE)
+_TG_STAMP = time.monotonic()
+_TG_LOCK = asyncio.Lock()
+
+# (chat_id, message_id) -> newest queued edit; an edit that is overtaken while waiting for a token is
+# dropped without spending one, so a user mashing catalog buttons only costs the final edit.
+_EDIT_SEQ: dict[tuple, int] = {}
+_EDIT_COUNTER = itertools.count()
+
+# Returns False (and spends nothing) when the edit identified by edit_key/edit_seq has been overtaken.
+async def tg_throttle(edit_key=None, edit_seq=None) -> bool:
+    global _TG_TOKENS, _TG_STAMP
+    async with _TG_LOCK:
+        if edit_key is not None and _EDIT_SEQ.get(edit_key) != edit_seq: return False
+        now = time.monotonic()
+        _TG_TOKENS = min(TG_RATE, _TG_TOKENS + (now - _TG_STAMP) * TG_RATE); _TG_STAMP = now
+        if _TG_TOKENS < 1:
+            await asyncio.sleep((1 - _TG_TOKENS) / TG_RATE)
+            _TG_TOKENS, _TG_STAMP = 1.0, time.monotonic()
+            if edit_key is not None and _EDIT_SEQ.get(edit_key) != edit_seq: return False
+        _TG_TOKENS -= 1
+        return True
+
+@bot.session.middleware()
+async def rate_limit_middleware(make_request, b, method):
+    if isinstance(method, EditMessageText) and method.message_id:
+        key = (method.chat_id, method.message_id)
+        seq = _EDIT_SEQ[key] = next(_EDIT_COUNTER)
+        if not await tg_throttle(key, seq): return True
+        del _EDIT_SEQ[key]
+    elif isinstance(method, SendMessage):
+        await tg_throttle()
+    return await make_request(b, method)
+
+# One bounded queue + worker per chat keeps messages ordered and lets DB-side handlers return
+# without waiting on Telegram; the worker exits (and drops its queue) once it has drained.
+SEND_QUEUE_MAX = 50
+SEND_RETRIES = 3
+SEND_QUEUES: dict[int, asyncio.Queue] = {}
+_SEND_TASKS: set[asyncio.Task] = set()
+
+async def _send_worker(chat_id: int, q: asyncio.Queue):
+    try:
+        while not q.empty():
+            text, kwargs = q.get_nowait()
+            # A dropped message may be a purchased credential: log it at error so support can re-send it
+            # from sales_history (the text itself stays out of the log).
+            for _ in range(SEND_RETRIES):
+                try:
+                    await bot.send_message(chat_id, text, **kwargs); break
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                except Exception:
+                    log.exception("send to %s failed, message dropped", chat_id); break
+            else:
+                log.error("send to %s still rate limited after %d tries, message dropped", chat_id, SEND_RETRIES)
+    finally:
+        SEND_QUEUES.pop(chat_id, None)
+
+def queue_message(chat_id: int, text: str, **kwargs):
+    q = SEND_QUEUES.get(chat_id)
+    if q is None:
+        q = SEND_QUEUES[chat_id] = asyncio.Queue(SEND_QUEUE_MAX)
+        task = asyncio.create_task(_send_worker(chat_id, q))
+        _SEND_TASKS.add(task); task.add_done_callback(_SEND_TASKS.discard)
+    try: q.put_nowait((text, kwargs))
+    except asyncio.QueueFull: log.error("send queue full for %s, message dropped", chat_id)
+
 # ==================== USER HANDLERS ====================
 @dp.message(Command("start"))
 async def start_cmd(m: Message):
     await get_or_create_user(m.from_user.id)
-    await m.answer("أهلًا بك 👋\nاختر من القائمة:", reply_markup=main_menu_kb())
+    await m.answer("أهلًا بك 👋\nاختر من القائمة:", reply_markup=MAIN_MENU_KB)
 
 @dp.message(Command("whoami"))
 async def whoami_cmd(m: Message):
@@ -252,12 +496,12 @@ async def whoami_cmd(m: Message):
 @dp.message(Command("balance"))
 async def balance_cmd(m: Message):
     bal = await get_or_create_user(m.from_user.id)
-    await m.answer(f"رصيدك الحالي: {bal:g} ج.م", reply_markup=main_menu_kb())
+    await m.answer(f"رصيدك الحالي: {bal:g} ج.م", reply_markup=MAIN_MENU_KB)
 
 @dp.callback_query(F.data == "balance")
 async def cb_balance(c: CallbackQuery):
     bal = await get_or_create_user(c.from_user.id)
-    await c.message.edit_text(f"رصيدك الحالي: {bal:g} ج.م", reply_markup=main_menu_kb())
+    await c.message.edit_text(f"رصيدك الحالي: {bal:g} ج.م", reply_markup=MAIN_MENU_KB)
 
 @dp.callback_query(F.data == "charge_menu")
 async def cb_charge_menu(c: CallbackQuery):
@@ -265,12 +509,11 @@ async def cb_charge_menu(c: CallbackQuery):
 
 @dp.callback_query(F.data == "back_home")
 async def cb_back_home(c: CallbackQuery):
-    await c.message.edit_text("اختر من القائمة:", reply_markup=main_menu_kb())
+    await c.message.edit_text("اختر من القائمة:", reply_markup=MAIN_MENU_KB)
 
 # ==================== ADMIN HANDLERS ====================
-@dp.message(Command("addbal"))
+@dp.message(Command("addbal"), ADMIN_ONLY)
 async def addbal_cmd(m: Message, command: CommandObject):
-    if not is_admin(m.from_user.id): return
     if not command.args: await m.reply("⚠️ الاستخدام: /addbal <user_id> <amount>"); return
     parts = command.args.split(maxsplit=1)
     uid = parse_int_loose(parts[0])
@@ -279,16 +522,14 @@ async def addbal_cmd(m: Message, command: CommandObject):
     await change_balance(uid, amt)
     await m.reply("✅ تم الشحن.")
 
-@dp.message(Command("clearstock"))
+@dp.message(Command("clearstock"), ADMIN_ONLY)
 async def clearstock_cmd(m: Message, command: CommandObject):
-    if not is_admin(m.from_user.id): return
     if not command.args: await m.reply("⚠️ الاستخدام: /clearstock <category>"); return
     count = await clear_stock_category(command.args.strip())
     await m.reply(f"🧹 تم حذف {count} عنصر.")
 
-@dp.message(Command("delstock"))
+@dp.message(Command("delstock"), ADMIN_ONLY)
 async def delstock_cmd(m: Message, command: CommandObject):
-    if not is_admin(m.from_user.id): return
     if not command.args: await m.reply("⚠️ الاستخدام: /delstock <stock_id>"); return
     stock_id = parse_int_loose(command.args)
     if stock_id is None: await m.reply("⚠️ يرجى إدخال معرف (ID) صحيح للمنتج."); return
@@ -298,9 +539,8 @@ async def delstock_cmd(m: Message, command: CommandObject):
     else:
         await m.reply("⚠️ لم يتم العثور على المنتج بهذا المعرف."); return
 
-@dp.message(Command("liststock"))
+@dp.message(Command("liststock"), ADMIN_ONLY)
 async def liststock_cmd(m: Message, command: CommandObject):
-    if not is_admin(m.from_user.id): return
     if not command.args: await m.reply("⚠️ الاستخدام: /liststock <category> [limit]"); return
     parts = command.args.split(maxsplit=1)
     category = parts[0]
@@ -316,18 +556,16 @@ async def liststock_cmd(m: Message, command: CommandObject):
         lines.append(f"- ID={sid} | {prices} | {cred}")
     await m.reply("\n".join(lines))
 
-@dp.message(Command("stock"))
+@dp.message(Command("stock"), ADMIN_ONLY)
 async def stock_cmd(m: Message):
-    if not is_admin(m.from_user.id): return
     rows = await list_categories()
     if not rows: await m.reply("لا يوجد مخزون."); return
     lines = ["المخزون الحالي (حسب الفئات):"] + [f"- {cat}: {cnt} عنصر متاح" for cat, cnt in rows]
     lines.append("\nاستخدم /liststock <category> لعرض IDs.")
     await m.reply("\n".join(lines))
 
-@dp.message(Command("sales"))
+@dp.message(Command("sales"), ADMIN_ONLY)
 async def sales_history_cmd(m: Message, command: CommandObject):
-    if not is_admin(m.from_user.id): return
     limit = 20
     if command.args and (limit_arg := parse_int_loose(command.args)):
         limit = max(1, min(limit_arg, 100))
@@ -338,24 +576,21 @@ async def sales_history_cmd(m: Message, command: CommandObject):
         lines.append(f"👤 `{uid}`\n🛍️ `{cat}` ({mode}) | {price:g} ج.م\n🗓️ {pdate}\n`{cred}`\n---")
     await m.reply("\n".join(lines), parse_mode="Markdown")
 
-@dp.message(Command("setinstructions"))
+@dp.message(Command("setinstructions"), ADMIN_ONLY)
 async def setinstructions_cmd(m: Message):
-    if not is_admin(m.from_user.id): return
     parts = (m.text or "").split(maxsplit=3)
-    valid_modes = ["personal", "shared", "laptop"]
     if len(parts) < 4:
-        await m.reply(f"⚠️ الاستخدام: /setinstructions <category> <mode> <message>\nالأنماط: {', '.join(valid_modes)}")
+        await m.reply(f"⚠️ الاستخدام: /setinstructions <category> <mode> <message>\nالأنماط: {', '.join(MODE_NAMES)}")
         return
     category, mode, message = parts[1], parts[2].lower(), parts[3]
-    if mode not in valid_modes:
-        await m.reply(f"⚠️ نمط غير صحيح. الأنماط: {', '.join(valid_modes)}")
+    if mode not in MODE_NAMES:
+        await m.reply(f"⚠️ نمط غير صحيح. الأنماط: {', '.join(MODE_NAMES)}")
         return
     await set_instruction(category, mode, message)
     await m.reply(f"✅ تم حفظ التعليمات لـ: {category} ({mode})")
 
-@dp.message(Command("delinstructions"))
+@dp.message(Command("delinstructions"), ADMIN_ONLY)
 async def delinstructions_cmd(m: Message, command: CommandObject):
-    if not is_admin(m.from_user.id): return
     parts = (command.args or "").strip().split(maxsplit=1)
     if len(parts) < 2:
         await m.reply("⚠️ الاستخدام: /delinstructions <category> <mode>"); return
@@ -363,9 +598,8 @@ async def delinstructions_cmd(m: Message, command: CommandObject):
     deleted = await delete_instruction(category, mode)
     await m.reply(f"✅ تم حذف التعليمات." if deleted else "⚠️ لا توجد تعليمات لهذه الفئة والنمط.")
 
-@dp.message(Command("viewinstructions"))
+@dp.message(Command("viewinstructions"), ADMIN_ONLY)
 async def viewinstructions_cmd(m: Message, command: CommandObject):
-    if not is_admin(m.from_user.id): return
     if command.args:
         parts = command.args.strip().split(maxsplit=1)
         category = parts[0]
@@ -373,113 +607,168 @@ async def viewinstructions_cmd(m: Message, command: CommandObject):
             mode = parts[1].lower()
             msg = await get_instruction(category, mode)
             if not msg: await m.reply("لا توجد تعليمات لهذه الفئة والنمط."); return
-            await m.reply(f"<b>تعليمات: {escape(category)} ({escape(mode)})</b>\n\n{msg}", parse_mode="HTML")
+            await m.reply(f"<b>تعليمات: {escape(category)} ({mode})</b>\n\n{msg}", parse_mode="HTML")
         else:
             all_inst = await get_all_instructions()
             cat_inst = [i for i in all_inst if i[0] == category]
             if not cat_inst: await m.reply("لا توجد تعليمات لهذه الفئة."); return
             lines = [f"📜 <b>تعليمات فئة: {escape(category)}</b>"]
-            for cat, md, text in cat_inst: lines.append(f"\n--- <b>{escape(md)}</b> ---\n{text}")
+            for cat, md, text in cat_inst: lines.append(f"\n--- <b>{md}</b> ---\n{text}")
             await m.reply("\n".join(lines), parse_mode="HTML")
     else:
         all_inst = await get_all_instructions()
         if not all_inst: await m.reply("لا توجد أي تعليمات محفوظة."); return
         lines = ["📜 <b>جميع التعليمات المحفوظة:</b>"]
-        for cat, md, text in all_inst: lines.append(f"\n--- <b>{escape(cat)} ({escape(md)})</b> ---\n{text}")
+        for cat, md, text in all_inst: lines.append(f"\n--- <b>{escape(cat)} ({md})</b> ---\n{text}")
         await m.reply("\n".join(lines), parse_mode="HTML")
 
 # ==================== IMPORT LOGIC & HANDLERS ====================
-@dp.message(Command("importstock"))
+@dp.message(Command("importstock"), ADMIN_ONLY)
 async def importstock_cmd(m: Message):
-    if not is_admin(m.from_user.id): return
     await m.reply("📥 أرسل ملف TXT أو الصق سطور بصيغة:\n<category> <price> <credential>")
     dp.workflow_state = {"awaiting_import": {"admin": m.from_user.id}}
 
-@dp.message(Command("importstockm", "addstockm"))
+@dp.message(Command("importstockm", "addstockm"), ADMIN_ONLY)
 async def importstockm_cmd(m: Message):
-    if not is_admin(m.from_user.id): return
     await m.reply("📥 أرسل TXT أو الصق سطور بصيغة:\n<cat> <p_p> <p_c> <s_p> <s_c> <l_p> <l_c> <cred>")
     dp.workflow_state = {"awaiting_importm": {"admin": m.from_user.id}}
 
+# Whole-line shapes for the import formats; the credential is everything after the last numeric field.
+_STOCK_LINE_RE = re.compile(r'(\S+)\s+(\S+)\s+(\S.*)')
+_STOCKM_LINE_RE = re.compile(r'(\S+)' + r'\s+(\S+)' * 6 + r'\s+(\S.*)')
+
+# Both parsers emit rows in STOCK_INSERT_SQL order (category, price, credential, p_price, p_cap,
+# s_price, s_cap, l_price, l_cap), so the batch goes straight to add_stock_rows.
 def parse_stock_lines(text: str):
-    ok, fail, res = 0, 0, []
+    ok = fail = 0; rows = []
+    match, pfl, add = _STOCK_LINE_RE.fullmatch, parse_float_loose, rows.append
     for raw in (text or "").splitlines():
         line = raw.strip()
-        if not line or line.startswith("#"): continue
-        parts = line.split(maxsplit=2)
-        if len(parts) < 3: fail += 1; continue
-        cat, price_s, cred = parts[0], parts[1], parts[2]
-        price = parse_float_loose(price_s)
-        if price is None or not cred: fail += 1; continue
-        res.append((cat, price, cred)); ok += 1
-    return res, ok, fail
+        if not line or line[0] == "#": continue
+        m = match(line)
+        if not m: fail += 1; continue
+        cat, price_s, cred = m.groups()
+        price = pfl(price_s)
+        if price is None: fail += 1; continue
+        add((cat, 0, cred, price, 1, None, 0, None, 0)); ok += 1
+    return rows, ok, fail
 
 def parse_stockm_lines(text: str):
-    results = []; ok = fail = 0
+    ok = fail = 0; rows = []
+    match, pfl, pil, add = _STOCKM_LINE_RE.fullmatch, parse_float_loose, parse_int_loose, rows.append
     for raw in (text or "").splitlines():
         line = raw.strip()
-        if not line or line.startswith("#"): continue
-        parts = line.split(maxsplit=7)
-        if len(parts) < 8: fail += 1; continue
-        cat, p_pr_s, p_c_s, s_pr_s, s_c_s, l_pr_s, l_c_s, cred = parts
-        p_price = parse_float_loose(p_pr_s); p_cap = parse_int_loose(p_c_s)
-        s_price = parse_float_loose(s_pr_s); s_cap = parse_int_loose(s_c_s)
-        l_price = parse_float_loose(l_pr_s); l_cap = parse_int_loose(l_c_s)
-        if any(v is None for v in [p_price,p_cap,s_price,s_cap,l_price,l_cap]): fail += 1; continue
-        results.append((cat, p_price, p_cap, s_price, s_cap, l_price, l_cap, cred)); ok += 1
-    return results, ok, fail
-    
-async def process_import(text: str, is_multi_mode: bool, message: Message):
+        if not line or line[0] == "#": continue
+        m = match(line)
+        if not m: fail += 1; continue
+        cat, p_pr_s, p_c_s, s_pr_s, s_c_s, l_pr_s, l_c_s, cred = m.groups()
+        vals = (pfl(p_pr_s), pil(p_c_s), pfl(s_pr_s), pil(s_c_s), pfl(l_pr_s), pil(l_c_s))
+        if None in vals: fail += 1; continue
+        add((cat, 0, cred) + vals); ok += 1
+    return rows, ok, fail
+
+IMPORT_BATCH_LINES = 1000
+IMPORT_MAX_BYTES = 20 * 1024 * 1024  # Bot API getFile limit; larger files can't be downloaded anyway
+
+async def import_text(text: str, is_multi_mode: bool):
+    rows, ok, fail = (parse_stockm_lines if is_multi_mode else parse_stock_lines)(text)
+    await add_stock_rows(rows)
+    return ok, fail
+
+async def reply_import_result(message: Message, ok: int, fail: int, is_multi_mode: bool):
     if is_multi_mode:
-        rows, ok, fail = parse_stockm_lines(text)
-        for cat, p_price, p_cap, s_price, s_cap, l_price, l_cap, cred in rows:
-            await add_stock_row_modes(cat, cred, p_price, p_cap, s_price, s_cap, l_price, l_cap)
         await message.reply(f"✅ تم استيراد {ok} (مودات). ❌ فشل {fail}.")
     else:
-        rows, ok, fail = parse_stock_lines(text)
-        for cat, price, cred in rows:
-            await add_stock_simple(cat, price, cred)
         await message.reply(f"✅ تم استيراد {ok}. ❌ فشل {fail}.")
 
-@dp.message(F.document)
-async def import_file_handler(m: Message):
+async def process_import(text: str, is_multi_mode: bool, message: Message):
+    ok, fail = await import_text(text, is_multi_mode)
+    await reply_import_result(message, ok, fail, is_multi_mode)
+
+async def iter_file_lines(file_path: str):
+    # Yields lines as chunks arrive; only the unfinished tail of the last chunk is buffered.
+    url = bot.session.api.file_url(bot.token, file_path)
+    buf = bytearray()
+    async for chunk in bot.session.stream_content(url=url, chunk_size=65536):
+        buf += chunk
+        idx = buf.rfind(b"\n")
+        if idx < 0: continue
+        for line in bytes(buf[:idx]).split(b"\n"):
+            yield line.decode("utf-8", "ignore")
+        del buf[:idx + 1]
+    if buf:
+        yield buf.decode("utf-8", "ignore")
+
+def awaiting_import(m: Message) -> bool:
     st = getattr(dp, "workflow_state", {})
-    w_m = st.get("awaiting_importm"); w_s = st.get("awaiting_import")
-    if not (w_m or w_s) or not is_admin(m.from_user.id): return
-    if (w_m and w_m.get("admin") != m.from_user.id) or \
-       (w_s and w_s.get("admin") != m.from_user.id): return
+    w = st.get("awaiting_importm") or st.get("awaiting_import")
+    return bool(w) and w.get("admin") == m.from_user.id
+
+TXT_DOCUMENT = (F.document.mime_type == "text/plain") | F.document.file_name.lower().endswith(".txt")
+
+@dp.message(F.document, TXT_DOCUMENT, ADMIN_ONLY, F.func(awaiting_import))
+async def import_file_handler(m: Message):
     doc: Document = m.document
-    if not (doc.mime_type == "text/plain" or (doc.file_name and doc.file_name.lower().endswith(".txt"))):
-        await m.reply("⚠️ أرسل ملف .txt فقط."); return
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        await m.reply("⚠️ الملف كبير جدًا (الحد الأقصى 20 ميجابايت)."); return
+    is_multi_mode = bool(dp.workflow_state.get("awaiting_importm"))
+    ok = fail = 0
+    batch = []
     try:
         file = await bot.get_file(doc.file_id)
-        from io import BytesIO
-        buf = BytesIO()
-        await bot.download(file, buf)
-        text = buf.getvalue().decode("utf-8", "ignore")
+        # Rows are committed every IMPORT_BATCH_LINES lines while the download is still streaming.
+        async for line in iter_file_lines(file.file_path):
+            batch.append(line)
+            if len(batch) >= IMPORT_BATCH_LINES:
+                b_ok, b_fail = await import_text("\n".join(batch), is_multi_mode)
+                ok += b_ok; fail += b_fail; batch.clear()
     except Exception as e:
-        await m.reply(f"❌ فشل تنزيل الملف: {e}"); return
-    await process_import(text, is_multi_mode=bool(w_m), message=m)
+        await m.reply(f"❌ فشل تنزيل الملف: {e}\n(تم استيراد {ok} قبل التوقف)"); return
+    b_ok, b_fail = await import_text("\n".join(batch), is_multi_mode)
+    await reply_import_result(m, ok + b_ok, fail + b_fail, is_multi_mode)
     dp.workflow_state = {}
 
+@dp.message(F.document, ADMIN_ONLY, F.func(awaiting_import))
+async def reject_non_txt_document(m: Message):
+    await m.reply("⚠️ أرسل ملف .txt فقط.")
+
 # ==================== PAYMOB INTEGRATION ====================
 PAYMOB_AUTH_URL = "https://accept.paymob.com/api/auth/tokens"
 PAYMOB_ORDER_URL = "https://accept.paymob.com/api/ecommerce/orders"
 PAYMOB_PAYMENT_KEY_URL = "https://accept.paymob.com/api/acceptance/payment_keys"
 PAYMOB_IFRAME_URL = f"https://accept.paymob.com/api/acceptance/iframes/{PAYMOB_IFRAME_ID}?payment_token={{}}"
 
+# One session for all Paymob calls so the three-step charge flow reuses a kept-alive connection;
+# opened in main() and closed on shutdown.
+HTTP: aiohttp.ClientSession | None = None
+
 async def get_auth_token():
-    async with aiohttp.ClientSession() as session:
-        async with session.post(PAYMOB_AUTH_URL, json={"api_key": PAYMOB_API_KEY}) as response:
-            data = await response.json()
-            return data.get("token")
+    async with HTTP.post(PAYMOB_AUTH_URL, json={"api_key": PAYMOB_API_KEY}) as response:
+        data = orjson.loads(await response.read())
+        return data.get("token")
+
+# Paymob auth tokens live for an hour; reuse one across charges and let concurrent misses share a single fetch.
+PAYMOB_TOKEN_TTL = 50 * 60
+_PAYMOB_AUTH = {"token": None, "exp": 0.0}
+_PAYMOB_AUTH_LOCK = asyncio.Lock()
+
+async def cached_auth_token():
+    if time.monotonic() < _PAYMOB_AUTH["exp"]: return _PAYMOB_AUTH["token"]
+    async with _PAYMOB_AUTH_LOCK:
+        if time.monotonic() >= _PAYMOB_AUTH["exp"]:
+            token = await get_auth_token()
+            if not token: return None
+            _PAYMOB_AUTH.update(token=token, exp=time.monotonic() + PAYMOB_TOKEN_TTL)
+        return _PAYMOB_AUTH["token"]
+
+def drop_auth_token():
+    _PAYMOB_AUTH["exp"] = 0.0
 
 async def register_order(token: str, merchant_order_id: str, amount_cents: int):
     payload = {"auth_token": token, "delivery_needed": "false", "amount_cents": str(amount_cents), "currency": "EGP", "merchant_order_id": merchant_order_id}
-    async with aiohttp.ClientSession() as session:
-        async with session.post(PAYMOB_ORDER_URL, json=payload) as response:
-            data = await response.json()
-            return data.get("id")
+    async with HTTP.post(PAYMOB_ORDER_URL, json=payload) as response:
+        data = orjson.loads(await response.read())
+        return data.get("id")
 
 async def get_payment_key(token: str, order_id: int, amount_cents: int, integration_id: int):
     payload = {
@@ -487,10 +776,9 @@ async def get_payment_key(token: str, order_id: int, amount_cents: int, integrat
         "billing_data": {"email": "NA", "first_name": "NA", "last_name": "NA", "phone_number": "NA", "apartment": "NA", "floor": "NA", "street": "NA", "building": "NA", "shipping_method": "NA", "postal_code": "NA", "city": "NA", "country": "NA", "state": "NA"},
         "currency": "EGP", "integration_id": integration_id, "lock_order_when_paid": "true"
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(PAYMOB_PAYMENT_KEY_URL, json=payload) as response:
-            data = await response.json()
-            return data.get("token")
+    async with HTTP.post(PAYMOB_PAYMENT_KEY_URL, json=payload) as response:
+        data = orjson.loads(await response.read())
+        return data.get("token")
 
 @dp.message(Command("charge"))
 async def charge_cmd(m: Message, command: CommandObject):
@@ -500,10 +788,10 @@ async def charge_cmd(m: Message, command: CommandObject):
     if amount_egp is None or amount_egp < 5:
         await m.reply("⚠️ المبلغ يجب أن يكون رقمًا صحيحًا و 5 جنيهات أو أكثر."); return
     amount_cents = int(amount_egp * 100)
-    merchant_order_id = f"tg-{m.from_user.id}-{int(time.time())}"
+    merchant_order_id = f"tg-{m.from_user.id}-{time.time_ns():x}"
     
     try:
-        token = await get_auth_token()
+        token = await cached_auth_token()
         if not token: raise Exception("Failed to get auth token")
         order_id = await register_order(token, merchant_order_id, amount_cents)
         if not order_id: raise Exception("Failed to register order")
@@ -514,99 +802,130 @@ async def charge_cmd(m: Message, command: CommandObject):
         payment_url = PAYMOB_IFRAME_URL.format(payment_key)
         kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=f"💳 ادفع {amount_egp:g} جنيه الآن", url=payment_url)]])
         await m.reply("تم إنشاء فاتورة الدفع. اضغط على الزر أدناه لإتمام العملية.", reply_markup=kb)
-    except Exception as e:
-        print(f"[PAYMOB ERROR] {e}")
+    except Exception:
+        drop_auth_token()  # a revoked/expired token would otherwise fail every charge until the TTL ends
+        log.exception("paymob charge failed")
         await m.reply("حدث خطأ أثناء إنشاء فاتورة الدفع. يرجى المحاولة مرة أخرى لاحقًا.")
 
 # ==================== CATALOG & BUY ====================
+# The catalog keyboard only changes when the category counts do, so the last one built is reused.
+_CATALOG_KB: tuple = (None, None)
+
+def catalog_kb(rows):
+    global _CATALOG_KB
+    key = tuple(rows)
+    if _CATALOG_KB[0] != key:
+        kb = [[InlineKeyboardButton(text=f"{cat} — {cnt} عنصر", callback_data=f"cat::{cat}")] for cat, cnt in rows]
+        kb.append([BACK_HOME_BTN])
+        _CATALOG_KB = (key, InlineKeyboardMarkup(inline_keyboard=kb))
+    return _CATALOG_KB[1]
+
 @dp.callback_query(F.data == "catalog")
 async def cb_catalog(c: CallbackQuery):
+    # Answer first on every success path: the edit below may wait for a send token or be dropped
+    # as superseded, and the client keeps its spinner until the callback is answered.
+    await c.answer()
     rows = await list_categories()
-    if not rows: await c.message.edit_text("لا توجد مخزونات حاليًا.", reply_markup=main_menu_kb()); return
-    kb = [[InlineKeyboardButton(text=f"{cat} — {cnt} عنصر", callback_data=f"cat::{cat}")] for cat, cnt in rows]
-    kb.append([InlineKeyboardButton(text="🔙 رجوع", callback_data="back_home")])
-    await c.message.edit_text("🛍️ اختر فئة:", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    if not rows: await c.message.edit_text("لا توجد مخزونات حاليًا.", reply_markup=MAIN_MENU_KB); return
+    await c.message.edit_text("🛍️ اختر فئة:", reply_markup=catalog_kb(rows))
+
+# category -> (modes_info, keyboard); rebuilt only when that category's availability changes
+_MODES_KB: dict[str, tuple] = {}
 
 def modes_kb(modes_info, category):
-    name = {"personal":"فردي","shared":"مشترك","laptop":"لابتوب"}
+    hit = _MODES_KB.get(category)
+    if hit and hit[0] == modes_info: return hit[1]
     rows = []
-    for m in ["personal","shared","laptop"]:
+    for m, name in MODE_NAMES.items():
         if m in modes_info:
             mi = modes_info[m]
-            rows.append([InlineKeyboardButton(text=f"{name[m]} — من {mi['min_price']:g} ج.م ({mi['count']} عنصر)", callback_data=f"mode::{category}::{m}")])
-    rows.append([InlineKeyboardButton(text="🔙 رجوع", callback_data="catalog")])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+            rows.append([InlineKeyboardButton(text=f"{name} — من {mi['min_price']:g} ج.م ({mi['count']} عنصر)", callback_data=f"mode::{category}::{m}")])
+    rows.append([BACK_CATALOG_BTN])
+    kb = InlineKeyboardMarkup(inline_keyboard=rows)
+    _MODES_KB[category] = (modes_info, kb)
+    return kb
+
+@functools.lru_cache(maxsize=256)
+def buy_kb(category: str, mode: str):
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✅ شراء الآن", callback_data=f"buy::{category}::{mode}")],[InlineKeyboardButton(text="🔙 رجوع", callback_data=f"cat::{category}")]])
 
 @dp.callback_query(F.data.startswith("cat::"))
 async def cb_pick_category(c: CallbackQuery):
     category = c.data.split("::",1)[1]
     modes_info = await list_modes_for_category(category)
     if not modes_info: await c.answer("لا يوجد عناصر متاحة في هذه الفئة حاليًا.", show_alert=True); return
+    await c.answer()
     await c.message.edit_text(f"الفئة: {category}\nاختر النوع:", reply_markup=modes_kb(modes_info, category))
 
 @dp.callback_query(F.data.startswith("mode::"))
 async def cb_pick_mode(c: CallbackQuery):
     _, category, mode = c.data.split("::",2)
-    item = await find_item_with_mode(category, mode)
+    item = await peek_item_with_mode(category, mode)
     if not item: await c.answer("لا يوجد عنصر مناسب الآن.", show_alert=True); return
     price = price_for_mode(item, mode)
+    await c.answer()
     await c.message.edit_text(
         f"الفئة: {category}\nالنوع: {mode}\nالسعر: {price:g} ج.م\nاضغط شراء لإتمام العملية.",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✅ شراء الآن", callback_data=f"buy::{category}::{mode}")],[InlineKeyboardButton(text="🔙 رجوع", callback_data=f"cat::{category}")]]))
+        reply_markup=buy_kb(category, mode))
 
 @dp.callback_query(F.data.startswith("buy::"))
 async def cb_buy(c: CallbackQuery):
     _, category, mode = c.data.split("::",2)
-    row = await find_item_with_mode(category, mode)
-    if not row: await c.answer("لا يوجد عنصر متاح الآن.", show_alert=True); return
-    price = price_for_mode(row, mode)
-    bal = await get_or_create_user(c.from_user.id)
-    if bal < price:
-        await c.answer(f"رصيدك لا يكفي. السعر {price:g} ج.م ورصيدك {bal:g} ج.م", show_alert=True); return
-    if not await change_balance(c.from_user.id, -price):
-        await c.answer("فشل الخصم.", show_alert=True); return
-    ok = await increment_sale_and_finalize(row, mode)
-    if not ok:
-        await change_balance(c.from_user.id, +price)
-        await c.answer("نفذ المخزون أثناء الشراء.", show_alert=True); return
-    await log_sale(c.from_user.id, row, price, mode)
-    credential = escape(row[3])
-    
+    try:
+        res = await claim_and_log(c.from_user.id, category, mode)
+    except InsufficientBalance as e:
+        await c.answer(f"رصيدك لا يكفي. السعر {e.price:g} ج.م ورصيدك {e.balance:g} ج.م", show_alert=True); return
+    if res is None: await c.answer("لا يوجد عنصر متاح الآن.", show_alert=True); return
+    credential, price, _ = res
+    await c.answer()
+    credential = escape(credential)
+
     instructions = await get_instruction(category, mode)
     message_text = f"📩 <b>بيانات حسابك:</b>\n<code>{credential}</code>"
     if instructions: message_text += f"\n\n{instructions}"
-    try:
-        await bot.send_message(c.from_user.id, message_text, parse_mode="HTML")
-    except Exception: pass
+    queue_message(c.from_user.id, message_text, parse_mode="HTML")
 
     await c.message.edit_text(f"✅ تم الشراء: {category}\nالنوع: {mode}\nالسعر: {price:g} ج.م\n\nتم إرسال البيانات والتعليمات في رسالة خاصة.")
 
 # ==================== WEBHOOK LISTENER (WITH DIAGNOSTICS) ====================
-@flask_app.route('/')
-def health_check():
-    print("[FLASK] Health check endpoint was hit!")
-    return "Flask server is running!"
-
-@flask_app.route('/webhook', methods=['POST'])
-def paymob_webhook():
-    print("[WEBHOOK] Webhook received!")
-    data = request.json
-    obj = data.get('obj', {})
-    
-    received_hmac = request.headers.get('x-paymob-hmac-sha512')
-    if not received_hmac: return abort(400)
+def _hmac_concat_from_obj(obj: dict) -> str:
+    return f"{obj.get('amount_cents', '')}{obj.get('created_at', '')}{obj.get('currency', '')}{str(obj.get('error_occured', '')).lower()}{str(obj.get('has_parent_transaction', '')).lower()}{obj.get('id', '')}{obj.get('integration_id', '')}{str(obj.get('is_3d_secure', '')).lower()}{str(obj.get('is_auth', '')).lower()}{str(obj.get('is_capture', '')).lower()}{str(obj.get('is_refunded', '')).lower()}{str(obj.get('is_standalone_payment', '')).lower()}{str(obj.get('is_voided', '')).lower()}{obj['order'].get('id', '')}{obj.get('owner', '')}{str(obj.get('pending', '')).lower()}{obj['source_data'].get('pan', '')}{obj['source_data'].get('sub_type', '')}{obj['source_data'].get('type', '')}{str(obj.get('success', '')).lower()}"
 
-    concatenated_string = f"{obj.get('amount_cents', '')}{obj.get('created_at', '')}{obj.get('currency', '')}{str(obj.get('error_occured', '')).lower()}{str(obj.get('has_parent_transaction', '')).lower()}{obj.get('id', '')}{obj.get('integration_id', '')}{str(obj.get('is_3d_secure', '')).lower()}{str(obj.get('is_auth', '')).lower()}{str(obj.get('is_capture', '')).lower()}{str(obj.get('is_refunded', '')).lower()}{str(obj.get('is_standalone_payment', '')).lower()}{str(obj.get('is_voided', '')).lower()}{obj['order'].get('id', '')}{obj.get('owner', '')}{str(obj.get('pending', '')).lower()}{obj['source_data'].get('pan', '')}{obj['source_data'].get('sub_type', '')}{obj['source_data'].get('type', '')}{str(obj.get('success', '')).lower()}"
-    
-    h = hmac.new(PAYMOB_HMAC_SECRET.encode('utf-8'), concatenated_string.encode('utf-8'), hashlib.sha512)
-    calculated_hmac = h.hexdigest()
+def verify_paymob_hmac(obj: dict, received_hmac: str) -> bool:
+    # Without a secret anyone can sign with the empty key, so fail closed.
+    if not PAYMOB_HMAC_SECRET_BYTES: return False
+    # A SHA-512 hex digest is exactly 64 bytes; reject anything else before hashing.
+    try:
+        received = bytes.fromhex(received_hmac)
+    except ValueError:
+        return False
+    if len(received) != 64: return False
+    calculated = hmac.digest(PAYMOB_HMAC_SECRET_BYTES, _hmac_concat_from_obj(obj).encode('utf-8'), 'sha512')
+    return hmac.compare_digest(calculated, received)
+
+@routes.get('/')
+async def health_check(request: web.Request):
+    log.info("health check")
+    return web.Response(text="Web server is running!")
+
+@routes.post('/webhook')
+async def paymob_webhook(request: web.Request):
+    log.info("webhook received from %s", request.remote)
+    received_hmac = request.headers.get('x-paymob-hmac-sha512')
+    if not received_hmac: return web.Response(status=400)
+    raw = await request.read()
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return web.Response(status=400)
+    obj = data.get('obj', {})
 
-    if not hmac.compare_digest(calculated_hmac, received_hmac):
-        print("[WEBHOOK] HMAC verification failed!")
-        return abort(403)
+    if not verify_paymob_hmac(obj, received_hmac):
+        log.warning("webhook HMAC verification failed")
+        return web.Response(status=403)
 
     if data.get('type') == 'TRANSACTION' and obj.get('success'):
-        print("[WEBHOOK] Received successful transaction callback.")
+        log.info("webhook: successful transaction %s", obj.get('id'))
         try:
             merchant_order_id = obj['order']['merchant_order_id']
             if merchant_order_id and merchant_order_id.startswith('tg-'):
@@ -615,54 +934,66 @@ def paymob_webhook():
                 amount_cents = obj.get('amount_cents')
                 amount_egp = float(amount_cents) / 100
 
-                loop = dp.loop
-                asyncio.run_coroutine_threadsafe(change_balance(user_id, amount_egp), loop)
-                
+                await change_balance(user_id, amount_egp)
+
                 confirmation_message = f"✅ تم شحن رصيدك بنجاح بمبلغ {amount_egp:g} ج.م."
-                asyncio.run_coroutine_threadsafe(bot.send_message(user_id, confirmation_message), loop)
-        except Exception as e:
-            print(f"[WEBHOOK ERROR] Failed to process webhook: {e}")
-            
-    return ('', 200)
+                queue_message(user_id, confirmation_message)
+        except Exception:
+            log.exception("webhook processing failed")
+
+    return web.Response(status=200)
+
+# ==================== PASTED IMPORTS ====================
+# Registered last so commands still win; the filters keep every other user's text out of this handler.
+@dp.message(ADMIN_ONLY, F.func(awaiting_import))
+async def pasted_imports(m: Message):
+    w_m = dp.workflow_state.get("awaiting_importm")
+    await process_import(m.text or "", is_multi_mode=bool(w_m), message=m)
+    dp.workflow_state = {}
 
 # ==================== RUN ====================
+# Polling already runs each update as its own task; this caps how many run handlers at once.
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 256))
+_UPDATE_SLOTS = asyncio.Semaphore(UPDATE_CONCURRENCY)
+
+@dp.update.outer_middleware()
+async def update_concurrency_middleware(handler, event, data):
+    async with _UPDATE_SLOTS:
+        return await handler(event, data)
+
 async def main():
+    global HTTP
     await init_db()
-    
-    dp.loop = asyncio.get_running_loop()
-    
-    print("Bot started.")
+    await load_category_counts()
+    optimize_task = asyncio.create_task(optimize_db_loop())
+    HTTP = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=10),
+        connector=aiohttp.TCPConnector(limit=50, ttl_dns_cache=300, keepalive_timeout=60),
+    )
+
+    log.info("Bot started.")
     try:
         await bot.delete_webhook(drop_pending_updates=True)
     except Exception as e:
-        print("[WARN] delete_webhook:", e)
+        log.warning("delete_webhook failed: %s", e)
     
+    # The Paymob webhook is served from the same event loop as polling.
+    if not PAYMOB_HMAC_SECRET_BYTES:
+        log.warning("PAYMOB_HMAC_SECRET is not set; every Paymob webhook will be rejected")
     port = int(os.getenv("PORT", 8080))
-    threading.Thread(target=lambda: flask_app.run(host='0.0.0.0', port=port, debug=False), daemon=True).start()
+    web_app = web.Application()
+    web_app.add_routes(routes)
+    runner = web.AppRunner(web_app, access_log=None)  # paymob_webhook and health_check log each hit themselves
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port, backlog=256).start()
     
-    # This is a catch-all for pasted imports, must be registered last.
-    @dp.message()
-    async def pasted_imports(m: Message):
-        st = getattr(dp, "workflow_state", {})
-        w_m = st.get("awaiting_importm"); w_s = st.get("awaiting_import")
-        if (w_m and w_m.get("admin") == m.from_user.id) or \
-           (w_s and w_s.get("admin") == m.from_user.id):
-            if is_admin(m.from_user.id):
-                if w_m:
-                    rows, ok, fail = parse_stockm_lines(m.text or "")
-                    for row_data in rows:
-                        cat, p_price, p_cap, s_price, s_cap, l_price, l_cap, cred = row_data
-                        await add_stock_row_modes(cat, cred, p_price, p_cap, s_price, s_cap, l_price, l_cap)
-                    await m.reply(f"✅ تم استيراد {ok} (مودات). ❌ فشل {fail}.")
-                else: # w_s
-                    rows, ok, fail = parse_stock_lines(m.text or "")
-                    for cat, price, cred in rows:
-                        await add_stock_simple(cat, price, cred)
-                    await m.reply(f"✅ تم استيراد {ok}. ❌ فشل {fail}.")
-                dp.workflow_state = {}
-                return
-
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot, handle_as_tasks=True, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        optimize_task.cancel()
+        await runner.cleanup()
+        await HTTP.close()
+        await close_db()
 
 if __name__ == "__main__":
     asyncio.run(main())
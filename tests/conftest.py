@@ -0,0 +1,35 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:ABCDEFabcdef")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import bot
+
+
+async def fetch_one(sql, params=()):
+    async with bot.reader() as db, db.execute(sql, params) as cur:
+        return await cur.fetchone()
+
+
+@pytest.fixture
+def run_with_db(monkeypatch, tmp_path):
+    """Run a coroutine function against a fresh store.db in tmp_path and return its result."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, "CATEGORY_COUNTS", {})
+
+    def run(body):
+        async def main():
+            monkeypatch.setattr(bot, "DB_WRITE_LOCK", asyncio.Lock())
+            monkeypatch.setattr(bot, "DB_READERS", asyncio.Queue())
+            await bot.init_db()
+            try:
+                return await body()
+            finally:
+                await bot.close_db()
+        return asyncio.run(main())
+
+    return run
@@ -0,0 +1,45 @@
+import sqlite3
+
+import pytest
+
+import bot
+from conftest import fetch_one
+
+
+def test_failed_import_batch_is_not_committed_by_the_next_writer(run_with_db):
+    async def body():
+        rows = [("A", 0, "ok", 1.0, 1, None, 0, None, 0), ("A", 0, None, 1.0, 1, None, 0, None, 0)]
+        with pytest.raises(sqlite3.IntegrityError):
+            await bot.add_stock_rows(rows)
+        await bot.change_balance(1, 5)
+        return await fetch_one("SELECT COUNT(*) FROM stock")
+
+    assert run_with_db(body) == (0,)
+    assert bot.CATEGORY_COUNTS == {}
+
+
+def test_failed_purchase_is_rolled_back(run_with_db):
+    async def body():
+        await bot.import_text("A 10 1 0 0 0 0 cred", True)
+        await bot.change_balance(1, 15)
+        async with bot.writer() as db:
+            await db.execute("DROP TABLE sales_history")  # makes the sale INSERT fail after claim + debit
+        with pytest.raises(sqlite3.OperationalError):
+            await bot.claim_and_log(1, "A", "personal")
+        await bot.change_balance(2, 5)
+        return (await fetch_one("SELECT balance FROM users WHERE user_id=1"),
+                await fetch_one("SELECT IFNULL(p_sold,0), IFNULL(is_sold,0) FROM stock"))
+
+    assert run_with_db(body) == ((15.0,), (0, 0))
+    assert bot.CATEGORY_COUNTS == {"A": 1}
+
+
+def test_insufficient_balance_reports_price_and_balance(run_with_db):
+    async def body():
+        await bot.import_text("A 10 1 0 0 0 0 cred", True)
+        await bot.change_balance(1, 4)
+        with pytest.raises(bot.InsufficientBalance) as e:
+            await bot.claim_and_log(1, "A", "personal")
+        return e.value.balance, e.value.price, await fetch_one("SELECT IFNULL(p_sold,0) FROM stock")
+
+    assert run_with_db(body) == (4.0, 10.0, (0,))
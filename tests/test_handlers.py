@@ -0,0 +1,15 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import bot
+
+
+def test_catalog_answers_callback_before_editing(monkeypatch):
+    monkeypatch.setattr(bot, "CATEGORY_COUNTS", {"A": 1})
+    calls = []
+    c = MagicMock()
+    c.answer = AsyncMock(side_effect=lambda *a, **k: calls.append("answer"))
+    c.message.edit_text = AsyncMock(side_effect=lambda *a, **k: calls.append("edit"))
+
+    asyncio.run(bot.cb_catalog(c))
+    assert calls == ["answer", "edit"]
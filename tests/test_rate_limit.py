@@ -0,0 +1,41 @@
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:ABCDEFabcdef")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from aiogram.methods import EditMessageText, SendMessage
+
+import bot
+
+
+def test_overtaken_edits_do_not_delay_other_sends(monkeypatch):
+    rate = 5
+    monkeypatch.setattr(bot, "TG_RATE", rate)
+    sent = []
+
+    async def make_request(b, method):
+        sent.append((method, time.monotonic()))
+        return True
+
+    async def run():
+        # Start with an empty bucket so every request has to wait for a token.
+        monkeypatch.setattr(bot, "_TG_LOCK", asyncio.Lock())
+        monkeypatch.setattr(bot, "_TG_TOKENS", 0.0)
+        monkeypatch.setattr(bot, "_TG_STAMP", time.monotonic())
+        start = time.monotonic()
+        edits = [EditMessageText(chat_id=1, message_id=7, text=f"edit {i}") for i in range(10)]
+        other = SendMessage(chat_id=2, text="hello")
+        await asyncio.gather(*(bot.rate_limit_middleware(make_request, bot.bot, m) for m in edits + [other]))
+        return start
+
+    start = asyncio.run(run())
+    sent_edits = [m for m, _ in sent if isinstance(m, EditMessageText)]
+    assert [m.text for m in sent_edits] == ["edit 9"]
+    other_at = next(t for m, t in sent if isinstance(m, SendMessage)) - start
+    # Two tokens (the final edit and the other chat's message) take ~2/rate; spending one per
+    # dropped edit would push the send past 10/rate.
+    assert other_at < 3 / rate
+    assert not bot._EDIT_SEQ
@@ -0,0 +1,24 @@
+import asyncio
+import logging
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import bot
+
+
+def test_message_dropped_after_retries_is_logged_at_error(monkeypatch, caplog):
+    async def always_rate_limited(chat_id, text, **kwargs):
+        raise TelegramRetryAfter(method=SendMessage(chat_id=chat_id, text=text), message="slow down", retry_after=0)
+
+    monkeypatch.setattr(bot.bot, "send_message", always_rate_limited)
+
+    async def run():
+        bot.queue_message(7, "credential")
+        await asyncio.gather(*bot._SEND_TASKS)
+
+    with caplog.at_level(logging.ERROR, logger="bot"):
+        asyncio.run(run())
+    assert [(r.levelno, r.args[0]) for r in caplog.records] == [(logging.ERROR, 7)]
+    assert "credential" not in caplog.text
+    assert 7 not in bot.SEND_QUEUES
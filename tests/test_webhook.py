@@ -0,0 +1,48 @@
+import hmac
+
+import orjson
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import bot
+from conftest import fetch_one
+
+TRANSACTION = {
+    "amount_cents": 5000000, "created_at": "2024-01-01T00:00:00", "currency": "EGP", "error_occured": False,
+    "has_parent_transaction": False, "id": 1, "integration_id": 1, "is_3d_secure": False, "is_auth": False,
+    "is_capture": False, "is_refunded": False, "is_standalone_payment": True, "is_voided": False,
+    "order": {"id": 1, "merchant_order_id": "tg-42-1"}, "owner": 1, "pending": False,
+    "source_data": {"pan": "0000", "sub_type": "MasterCard", "type": "card"}, "success": True,
+}
+
+
+def signed(key: bytes) -> str:
+    return hmac.digest(key, bot._hmac_concat_from_obj(TRANSACTION).encode(), "sha512").hex()
+
+
+async def post_webhook(signature: str) -> int:
+    app = web.Application()
+    app.add_routes(bot.routes)
+    async with TestClient(TestServer(app)) as client:
+        body = orjson.dumps({"type": "TRANSACTION", "obj": TRANSACTION})
+        resp = await client.post("/webhook", data=body, headers={"x-paymob-hmac-sha512": signature})
+        return resp.status
+
+
+def test_empty_key_signature_is_rejected_when_secret_is_unset(run_with_db, monkeypatch):
+    monkeypatch.setattr(bot, "PAYMOB_HMAC_SECRET_BYTES", b"")
+
+    async def body():
+        return await post_webhook(signed(b"")), await fetch_one("SELECT balance FROM users WHERE user_id=42")
+
+    assert run_with_db(body) == (403, None)
+
+
+def test_valid_signature_credits_the_user(run_with_db, monkeypatch):
+    monkeypatch.setattr(bot, "PAYMOB_HMAC_SECRET_BYTES", b"secret")
+    monkeypatch.setattr(bot, "queue_message", lambda *a, **k: None)
+
+    async def body():
+        return await post_webhook(signed(b"secret")), await fetch_one("SELECT balance FROM users WHERE user_id=42")
+
+    assert run_with_db(body) == (200, (50000.0,))